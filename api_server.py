@@ -4,18 +4,39 @@ YouTube Downloader Web App
 Simple web application for downloading YouTube videos via downloaderto.com
 """
 
+import os
+
+# Set GEVENT_PATCH=1 to make blocking I/O cooperative when not running under
+# gunicorn's gevent worker (which patches on its own). Must run before anything
+# imports socket/ssl.
+if os.getenv('GEVENT_PATCH', '').lower() in ('1', 'true', 'yes'):
+    from gevent import monkey
+    monkey.patch_all()
+
 from flask import Flask, request, jsonify, send_from_directory, session, redirect, url_for, Response
 from flask_cors import CORS
+from werkzeug.utils import secure_filename
 import logging
-import os
+import re
+import traceback
 from pathlib import Path
 from functools import wraps
 import secrets
-from downloader import get_download_url, stream_download
-from stem_separator import DemucsSeparator
+import threading
+from downloader import get_download_url, invalidate_download_url, stream_download, download_to_file, CHUNK_SIZE
+from stem_separator import DemucsSeparator, prepare_audio
 import tempfile
 import shutil
-import zipfile
+import tarfile
+import zstandard
+from zipstream import ZipStream, ZIP_STORED
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+try:
+    from gevent import get_hub, monkey
+except ImportError:
+    get_hub = monkey = None
 
 # Get the directory where this script is located
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -36,13 +57,46 @@ logger = logging.getLogger(__name__)
 PORT = int(os.getenv('PORT', 5000))
 HOST = os.getenv('HOST', '0.0.0.0')
 APP_PASSWORD = os.getenv('APP_PASSWORD', 'CookieRocks')
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 5))
+
+# Background work that overlaps with request handling (e.g. model warmup during downloads)
+_background = ThreadPoolExecutor(max_workers=2, thread_name_prefix='background')
+
+# Shared Demucs separator, created on first use and kept for the life of the process
+_separator_singleton = None
+_sep_lock = threading.Lock()
+# Model load started alongside the separator, shared by every request that needs the model
+_separator_warmup: Optional[Future] = None
+# Demucs runs one separation at a time; concurrent jobs queue here
+_separate_lock = threading.Lock()
+# Caps simultaneous audio fetches from the CDN so a burst of stem jobs doesn't get throttled
+_download_slots = threading.BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
+
+
+def _run_blocking(fn, *args, **kwargs):
+    """Call fn, on a native thread when running under gevent so CPU-heavy work doesn't stall other requests."""
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+
+def get_separator() -> DemucsSeparator:
+    """Return the process-wide Demucs separator, creating it on first use."""
+    global _separator_singleton, _separator_warmup
+    if _separator_singleton is None:
+        with _sep_lock:
+            if _separator_singleton is None:
+                separator = DemucsSeparator(model="htdemucs")
+                # Load the model once in the background; set before publishing the separator
+                _separator_warmup = _background.submit(_run_blocking, separator.warmup)
+                _separator_singleton = separator
+    return _separator_singleton
 
 
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors and return JSON instead of HTML."""
     logger.error(f"Internal server error: {error}")
-    import traceback
     logger.error(traceback.format_exc())
     return jsonify({
         'success': False,
@@ -54,7 +108,6 @@ def internal_error(error):
 def handle_exception(e):
     """Handle all unhandled exceptions and return JSON."""
     logger.error(f"Unhandled exception: {e}")
-    import traceback
     logger.error(traceback.format_exc())
     return jsonify({
         'success': False,
@@ -62,6 +115,34 @@ def handle_exception(e):
     }), 500
 
 
+def _iter_tar_zst(members):
+    """
+    Yield a zstd-compressed tar stream of (path, arcname) members.
+    
+    The tar framing is written by hand so compressed output can be yielded
+    as each file is read, rather than buffering whole members in memory.
+    zstd compresses on all cores (threads=-1).
+    """
+    chunker = zstandard.ZstdCompressor(level=3, threads=-1).chunker(chunk_size=CHUNK_SIZE)
+    for path, arcname in members:
+        info = tarfile.TarInfo(arcname)
+        info.size = os.path.getsize(path)
+        info.mtime = int(os.path.getmtime(path))
+        yield from chunker.compress(info.tobuf(format=tarfile.PAX_FORMAT))
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(CHUNK_SIZE)
+                if not block:
+                    break
+                yield from chunker.compress(block)
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield from chunker.compress(tarfile.NUL * padding)
+    # End-of-archive marker: two empty blocks
+    yield from chunker.compress(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+    yield from chunker.finish()
+
+
 def login_required(f):
     """Decorator to require authentication for routes."""
     @wraps(f)
@@ -196,7 +277,6 @@ def download():
         
         # Determine filename
         if video_title:
-            import re
             safe_title = re.sub(r'[^\w\s-]', '', video_title)
             safe_title = re.sub(r'[-\s]+', '-', safe_title)
             filename = f"{safe_title}.{file_format or 'mp4'}"
@@ -212,6 +292,8 @@ def download():
                     yield chunk
             except Exception as e:
                 logger.error(f"Error streaming download: {e}")
+                # The link may have expired; resolve it afresh on the next request
+                invalidate_download_url(youtube_url)
                 raise
         
         response = Response(
@@ -227,7 +309,6 @@ def download():
         
     except Exception as e:
         logger.error(f"Error processing download request: {e}")
-        import traceback
         logger.error(traceback.format_exc())
         return jsonify({
             'success': False,
@@ -235,14 +316,97 @@ def download():
         }), 500
 
 
+class _StemJob:
+    """Working directory and result of one stem separation, shared by every request waiting on it."""
+    
+    def __init__(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='stem_separation_')
+        # Resolves to (audio_file_path, stem_files, error_message)
+        self.future = Future()
+        self.refs = 1
+
+
+# (youtube_url, model, quality) -> job currently downloading/separating that video
+_stem_jobs: Dict[Tuple[str, str, str], _StemJob] = {}
+_stem_jobs_lock = threading.Lock()
+
+
+def _join_stem_job(key: Tuple[str, str, str]) -> Tuple[_StemJob, bool]:
+    """Return (job, is_leader): the in-flight job for key, or a new one the caller must run."""
+    with _stem_jobs_lock:
+        job = _stem_jobs.get(key)
+        if job is not None:
+            job.refs += 1
+            return job, False
+        job = _stem_jobs[key] = _StemJob()
+        return job, True
+
+
+def _release_stem_job(job: _StemJob):
+    """Drop one request's hold on a job; its files are removed once no response needs them."""
+    with _stem_jobs_lock:
+        job.refs -= 1
+        if job.refs > 0:
+            return
+    shutil.rmtree(job.temp_dir, ignore_errors=True)
+
+
+def _separate_saved_audio(audio_file_path: str, temp_dir: str, separator: DemucsSeparator, warmup,
+                          quality: str) -> Dict[str, str]:
+    """Run Demucs on an audio file once the model warmup has finished."""
+    # Resample up front so Demucs gets 44.1 kHz stereo input (the original is still what goes in the archive)
+    prepared_path = prepare_audio(audio_file_path, temp_dir)
+    
+    logger.info(f"Starting stem separation with Demucs v4 on {separator.device}...")
+    warmup.result()
+    output_dir = os.path.join(temp_dir, 'stems')
+    os.makedirs(output_dir, exist_ok=True)
+    
+    with _separate_lock:
+        return _run_blocking(separator.separate_audio, prepared_path, output_dir, quality=quality)
+
+
+def _separate_youtube_audio(youtube_url: str, temp_dir: str, separator: DemucsSeparator,
+                            warmup, quality: str) -> Tuple[Optional[str], Dict[str, str], Optional[str]]:
+    """Download a video's audio into temp_dir and separate it. Returns (audio_file_path, stem_files, error)."""
+    logger.info(f"Downloading audio from YouTube: {youtube_url}")
+    
+    # Get download URL
+    download_url, video_title, file_format = get_download_url(youtube_url)
+    
+    if not download_url:
+        return None, {}, 'Could not get download URL from y2down.cc'
+    
+    # Download audio file to temp directory
+    audio_filename = f"audio.{file_format or 'wav'}"
+    audio_file_path = os.path.join(temp_dir, audio_filename)
+    
+    logger.info(f"Downloading audio to: {audio_file_path}")
+    with _download_slots:
+        try:
+            download_to_file(download_url, audio_file_path)
+        except Exception:
+            # The link may have expired; resolve it afresh on the next request
+            invalidate_download_url(youtube_url)
+            raise
+    
+    logger.info(f"Audio downloaded successfully: {audio_file_path}")
+    
+    stem_files = _separate_saved_audio(audio_file_path, temp_dir, separator, warmup, quality)
+    if not stem_files:
+        return audio_file_path, {}, 'Stem separation failed or returned no stems'
+    return audio_file_path, stem_files, None
+
+
 @app.route('/api/separate-stems', methods=['POST'])
 @login_required
 def separate_stems():
-    """Separate audio into stems using AudioShake SDK."""
+    """Separate audio into stems using Demucs v4."""
     try:
-        data = request.get_json()
+        # Audio uploads arrive as multipart form data, YouTube URLs as JSON
+        data = request.form if request.files else request.get_json(silent=True)
         
-        if not data:
+        if not data and not request.files:
             return jsonify({
                 'success': False,
                 'error': 'Missing request body'
@@ -250,6 +414,10 @@ def separate_stems():
         
         youtube_url = data.get('youtube_url', '').strip()
         uploaded_file = request.files.get('audio_file')
+        compress = data.get('compress', False)
+        if isinstance(compress, str):
+            compress = compress.lower() in ('1', 'true', 'yes')
+        quality = data.get('quality', 'high')
         
         # Validate input
         if not youtube_url and not uploaded_file:
@@ -258,44 +426,46 @@ def separate_stems():
                 'error': 'Must provide either "youtube_url" or upload an audio file'
             }), 400
         
-        temp_dir = tempfile.mkdtemp(prefix='stem_separation_')
-        audio_file_path = None
+        if quality not in DemucsSeparator.OVERLAP_BY_QUALITY:
+            return jsonify({
+                'success': False,
+                'error': f'Invalid quality "{quality}", expected one of: {", ".join(DemucsSeparator.OVERLAP_BY_QUALITY)}'
+            }), 400
+        
+        if youtube_url and not (youtube_url.startswith('http://') or youtube_url.startswith('https://')):
+            return jsonify({
+                'success': False,
+                'error': 'Invalid URL format'
+            }), 400
+        
+        # Load the Demucs model while the audio is being fetched
+        separator = get_separator()
+        warmup = _separator_warmup
+        
+        if youtube_url:
+            # Concurrent requests for the same video share one download + separation
+            job_key = (youtube_url, separator.model, quality)
+            job, is_leader = _join_stem_job(job_key)
+        else:
+            job, is_leader = _StemJob(), True
+        temp_dir = job.temp_dir
+        keep_temp_dir = False
         
         try:
-            # Step 1: Get audio file (download from YouTube or use uploaded file)
-            if youtube_url:
-                logger.info(f"Downloading audio from YouTube: {youtube_url}")
-                
-                if not (youtube_url.startswith('http://') or youtube_url.startswith('https://')):
-                    return jsonify({
-                        'success': False,
-                        'error': 'Invalid URL format'
-                    }), 400
-                
-                # Get download URL
-                download_url, video_title, file_format = get_download_url(youtube_url)
-                
-                if not download_url:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Could not get download URL from y2down.cc'
-                    }), 500
-                
-                # Download audio file to temp directory
-                import requests
-                audio_filename = f"audio.{file_format or 'wav'}"
-                audio_file_path = os.path.join(temp_dir, audio_filename)
-                
-                logger.info(f"Downloading audio to: {audio_file_path}")
-                response = requests.get(download_url, stream=True, timeout=300)
-                response.raise_for_status()
-                
-                with open(audio_file_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                
-                logger.info(f"Audio downloaded successfully: {audio_file_path}")
+            # Step 1 + 2: Get audio file (download from YouTube or use uploaded file) and separate stems
+            if not is_leader:
+                logger.info(f"Waiting for in-flight stem separation of: {youtube_url}")
+                audio_file_path, stem_files, error = job.future.result()
+            elif youtube_url:
+                try:
+                    audio_file_path, stem_files, error = _separate_youtube_audio(youtube_url, temp_dir, separator, warmup, quality)
+                    job.future.set_result((audio_file_path, stem_files, error))
+                except Exception as e:
+                    job.future.set_exception(e)
+                    raise
+                finally:
+                    with _stem_jobs_lock:
+                        _stem_jobs.pop(job_key, None)
             else:
                 # Save uploaded file
                 if uploaded_file.filename == '':
@@ -304,76 +474,87 @@ def separate_stems():
                         'error': 'No file uploaded'
                     }), 400
                 
-                audio_file_path = os.path.join(temp_dir, uploaded_file.filename)
-                uploaded_file.save(audio_file_path)
+                # Never trust the client's filename for the path; only keep a sanitized extension
+                file_ext = os.path.splitext(secure_filename(uploaded_file.filename))[1].lower()
+                audio_file_path = os.path.join(temp_dir, f"upload{file_ext}")
+                # Werkzeug spools large uploads to disk; copy them across in big blocks
+                uploaded_file.save(audio_file_path, buffer_size=CHUNK_SIZE)
                 logger.info(f"Uploaded file saved to: {audio_file_path}")
+                
+                stem_files = _separate_saved_audio(audio_file_path, temp_dir, separator, warmup, quality)
+                error = None if stem_files else 'Stem separation failed or returned no stems'
             
-            # Step 2: Separate stems using Demucs v4
-            logger.info("Starting stem separation with Demucs v4...")
-            separator = DemucsSeparator(model="htdemucs")
-            output_dir = os.path.join(temp_dir, 'stems')
-            os.makedirs(output_dir, exist_ok=True)
-            
-            stem_files = separator.separate_audio(audio_file_path, output_dir)
-            
-            if not stem_files:
+            if error:
                 return jsonify({
                     'success': False,
-                    'error': 'Stem separation failed or returned no stems'
+                    'error': error
                 }), 500
             
             logger.info(f"Stem separation completed. Generated {len(stem_files)} stems")
             
-            # Step 3: Create zip archive of stems + original audio
-            zip_path = os.path.join(temp_dir, 'stems.zip')
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                # Add original audio file (always include it)
-                if audio_file_path and os.path.exists(audio_file_path):
-                    # Get file extension
-                    file_ext = os.path.splitext(audio_file_path)[1].lower()
-                    # Use appropriate name based on format
-                    if file_ext == '.wav':
-                        original_zip_name = 'original.wav'
-                    else:
-                        # Keep original extension but use clear name
-                        original_zip_name = f'original{file_ext}'
-                    
-                    zipf.write(audio_file_path, original_zip_name)
-                    logger.info(f"Added original audio to zip: {audio_file_path} as {original_zip_name}")
+            # Step 3: Collect archive entries (original audio + stems)
+            archive_members = []
+            # Add original audio file (always include it)
+            if audio_file_path and os.path.exists(audio_file_path):
+                # Get file extension
+                file_ext = os.path.splitext(audio_file_path)[1].lower()
+                # Use appropriate name based on format
+                if file_ext == '.wav':
+                    original_zip_name = 'original.wav'
+                else:
+                    # Keep original extension but use clear name
+                    original_zip_name = f'original{file_ext}'
                 
-                # Add all separated stems
-                for stem_name, stem_path in stem_files.items():
-                    if os.path.exists(stem_path):
-                        zipf.write(stem_path, os.path.basename(stem_path))
-                        logger.info(f"Added stem to zip: {stem_name} -> {os.path.basename(stem_path)}")
+                archive_members.append((audio_file_path, original_zip_name))
+                logger.info(f"Added original audio to archive: {audio_file_path} as {original_zip_name}")
             
-            logger.info(f"Created zip archive with original audio and {len(stem_files)} stems: {zip_path}")
+            # Add all separated stems
+            for stem_name, stem_path in stem_files.items():
+                if os.path.exists(stem_path):
+                    archive_members.append((stem_path, os.path.basename(stem_path)))
+                    logger.info(f"Added stem to archive: {stem_name} -> {os.path.basename(stem_path)}")
             
-            # Step 4: Return zip file
-            return send_from_directory(
-                temp_dir,
-                'stems.zip',
-                as_attachment=True,
-                download_name='separated_stems.zip',
-                mimetype='application/zip'
-            )
+            # Step 4: Stream the archive (never written to disk)
+            if compress:
+                logger.info(f"Streaming tar.zst archive with original audio and {len(stem_files)} stems")
+                response = Response(
+                    _iter_tar_zst(archive_members),
+                    mimetype='application/zstd',
+                    headers={
+                        'Content-Disposition': 'attachment; filename="separated_stems.tar.zst"',
+                    }
+                )
+            else:
+                zs = ZipStream(compress_type=ZIP_STORED, sized=True)
+                for path, arcname in archive_members:
+                    zs.add_path(path, arcname)
+                logger.info(f"Streaming zip archive with original audio and {len(stem_files)} stems")
+                response = Response(
+                    zs,
+                    mimetype='application/zip',
+                    headers={
+                        'Content-Disposition': 'attachment; filename="separated_stems.zip"',
+                        'Content-Length': str(len(zs)),
+                    }
+                )
+            # The archive is read from temp_dir while streaming, so only remove it once the response is closed
+            response.call_on_close(lambda: _release_stem_job(job))
+            keep_temp_dir = True
+            return response
             
         except Exception as e:
             logger.error(f"Error in stem separation: {e}")
-            import traceback
             logger.error(traceback.format_exc())
             return jsonify({
                 'success': False,
                 'error': f'Error during stem separation: {str(e)}'
             }), 500
         finally:
-            # Cleanup temp directory after a delay (to allow download to complete)
-            # In production, consider using a background task to clean up
-            pass
+            if not keep_temp_dir:
+                _release_stem_job(job)
     
     except Exception as e:
         logger.error(f"Error processing stem separation request: {e}")
-        import traceback
         logger.error(traceback.format_exc())
         return jsonify({
             'success': False,
@@ -392,6 +573,5 @@ if __name__ == '__main__':
         app.run(host=HOST, port=PORT, debug=False)
     except Exception as e:
         logger.error(f"Failed to start server: {e}")
-        import traceback
         logger.error(traceback.format_exc())
         raise
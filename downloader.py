@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 """
 Downloader module for integrating with downloaderto.com
-Uses Selenium headless browser to handle JavaScript-rendered content
+Tries a plain HTTP form POST first, falling back to a Selenium headless
+browser to handle JavaScript-rendered content
 """
 
+import atexit
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 import os
-from typing import Optional, Tuple
+import queue
+import re
+import shutil
+import threading
+import traceback
+from typing import Dict, Optional, Tuple
 import time
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -17,82 +26,392 @@ from selenium.webdriver.chrome.service import Service
 from selenium.common.exceptions import TimeoutException, NoSuchElementException, WebDriverException
 from selenium.webdriver.common.keys import Keys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+Y2DOWN_URL = "https://y2down.cc/enmw/"
+
+# Read/write size for streamed downloads (large chunks amortize per-chunk overhead)
+CHUNK_SIZE = 262144
+
+# Block size when saving downloads to disk; bigger than CHUNK_SIZE since no client waits on each block
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# y2down download links are short-lived, so resolved URLs are only reused for an hour
+URL_CACHE_TTL = 3600
+
+# Most videos whose resolved URLs are remembered; the least recently used are dropped first
+URL_CACHE_MAX_ENTRIES = 256
+
+# A cached URL that answered a probe this recently is reused without probing again (seconds)
+URL_PROBE_TTL = 30
+
+# How long a caller waits on another request's lookup of the same video (seconds)
+INFLIGHT_WAIT_TIMEOUT = 120
+
+# Number of headless Chrome instances kept alive between requests
+DRIVER_POOL_SIZE = int(os.getenv('DRIVER_POOL_SIZE', 2))
+
+# Large files are fetched as this many parallel HTTP Range requests when the server allows it
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', 6))
+
+# Files smaller than this are not worth splitting across connections
+RANGE_SPLIT_MIN_SIZE = 8 * 1024 * 1024
+
+# Try a plain HTTP form post before starting the browser. Off by default: y2down.cc builds
+# its links client-side, so the post rarely yields one and only delays the browser fallback
+Y2DOWN_HTTP_LOOKUP = os.getenv('Y2DOWN_HTTP_LOOKUP', '').lower() in ('1', 'true', 'yes')
+
+# Shared HTTP session so repeated requests to y2down and its CDN reuse keep-alive connections
+_session = requests.Session()
+_session.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': '*/*',
+    'Referer': 'https://y2down.cc/',
+})
+# Transient failures and throttling (429/5xx) on idempotent requests are retried with
+# exponential backoff plus jitter, honouring Retry-After headers up to the same 60s cap
+_retry = Retry(
+    total=4,
+    backoff_factor=0.5,
+    backoff_max=60,
+    backoff_jitter=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({'GET', 'HEAD'}),
+    respect_retry_after_header=True,
+    retry_after_max=60,
+    raise_on_status=False,
+)
+_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=_retry)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+# Patterns for download URLs embedded in page HTML, in order of preference
+_DL_URL_PATTERNS = [re.compile(p, re.IGNORECASE) for p in (
+    r'https?://[^\s"\'<>]+\.(?:mp4|mp3|webm|m4a|wav|flac)',
+    r'["\'](https?://[^"\']*download[^"\']*\.(?:mp4|mp3|webm|m4a|wav|flac)[^"\']*)["\']',
+    r'downloadUrl["\']?\s*[:=]\s*["\'](https?://[^"\']+)["\']',
+    r'url["\']?\s*[:=]\s*["\'](https?://[^"\']*\.(?:mp4|mp3|wav|m4a)[^"\']*)["\']',
+    r'https?://[^"\'\s<>]+/get/[^"\'\s<>]+',
+    r'https?://[^"\'\s<>]+/download/[^"\'\s<>]+',
+    r'https?://[^"\'\s<>]*y2down[^"\'\s<>]*/get[^"\'\s<>]+',
+)]
+_DIRECT_MEDIA_RE = re.compile(r'https?://[^\s"\'<>]+\.(?:mp4|mp3|wav|m4a)', re.IGNORECASE)
+_HTTP_URL_RE = re.compile(r'https?://[^\s"\'<>)]+')
+_FMT_EXT_RE = re.compile(r'\.(mp4|mp3|wav|m4a|webm|flac)', re.IGNORECASE)
+
+# youtube_url -> (expires_at, last_verified_at, (download_url, video_title, file_format))
+_url_cache: OrderedDict[str, Tuple[float, float, Tuple[str, Optional[str], Optional[str]]]] = OrderedDict()
+_url_cache_lock = threading.Lock()
+
+# youtube_url -> lookup currently in progress, shared by concurrent callers
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def _cache_download_url(youtube_url: str, entry: Tuple[float, float, Tuple[str, Optional[str], Optional[str]]]):
+    """Store a URL cache entry as most recently used, evicting the oldest past the size limit."""
+    with _url_cache_lock:
+        _url_cache[youtube_url] = entry
+        _url_cache.move_to_end(youtube_url)
+        while len(_url_cache) > URL_CACHE_MAX_ENTRIES:
+            _url_cache.popitem(last=False)
+
+
+def invalidate_download_url(youtube_url: str):
+    """Forget the cached download URL for a video, e.g. after fetching it failed."""
+    with _url_cache_lock:
+        _url_cache.pop(youtube_url, None)
+
+
+def _probe_still_valid(download_url: str) -> bool:
+    """Check that a cached download URL is still being served."""
+    try:
+        response = _session.head(download_url, allow_redirects=True, timeout=10)
+        return response.status_code < 400
+    except requests.RequestException as e:
+        logger.info(f"Cached download URL no longer reachable: {e}")
+        return False
+
 
 def get_download_url(youtube_url: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Get download URL from y2down.cc using headless browser."""
+    """Get download URL for a YouTube video, reusing recent results when still valid."""
+    with _url_cache_lock:
+        entry = _url_cache.get(youtube_url)
+        if entry:
+            _url_cache.move_to_end(youtube_url)
+    if entry:
+        expires_at, verified_at, hit = entry
+        now = time.time()
+        if now < expires_at:
+            if now - verified_at < URL_PROBE_TTL:
+                logger.info(f"Using cached download URL for: {youtube_url}")
+                return hit
+            if _probe_still_valid(hit[0]):
+                logger.info(f"Using cached download URL for: {youtube_url}")
+                _cache_download_url(youtube_url, (expires_at, time.time(), hit))
+                return hit
+        invalidate_download_url(youtube_url)
+    
+    # Concurrent lookups of the same video wait for the first one instead of starting their own
+    with _inflight_lock:
+        future = _inflight.get(youtube_url)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[youtube_url] = Future()
+    if not is_leader:
+        logger.info(f"Waiting for in-flight lookup of: {youtube_url}")
+        return future.result(timeout=INFLIGHT_WAIT_TIMEOUT)
+    
+    try:
+        result = _resolve_download_url(youtube_url)
+        if result[0]:
+            now = time.time()
+            _cache_download_url(youtube_url, (now + URL_CACHE_TTL, now, result))
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(youtube_url, None)
+
+
+def _create_driver() -> Optional[webdriver.Chrome]:
+    """Start a new headless Chrome driver, or return None if Chrome cannot be started."""
     driver = None
+    
+    # Setup Chrome options
+    chrome_options = Options()
+    chrome_options.add_argument('--headless')
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--window-size=1920,1080')
+    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36')
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+    # Only the page's HTML/JS matters for finding download links; skip images, CSS and fonts
+    chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+    chrome_options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.default_content_setting_values.notifications": 2,
+        "profile.managed_default_content_settings.stylesheets": 2,
+        "profile.managed_default_content_settings.fonts": 2,
+    })
+    
+    # Try to find Chrome/Chromium binary (for Render/Linux environments)
+    # Check environment variable first (set by Dockerfile)
+    chrome_binary_paths = [
+        os.getenv('CHROME_BIN'),  # From Dockerfile
+        '/usr/bin/chromium',
+        '/usr/bin/chromium-browser',
+        '/usr/bin/google-chrome',
+        '/usr/bin/chrome',
+    ]
+    # Filter out None values
+    chrome_binary_paths = [p for p in chrome_binary_paths if p]
+    chrome_binary = None
+    for path in chrome_binary_paths:
+        if os.path.exists(path):
+            chrome_binary = path
+            chrome_options.binary_location = chrome_binary
+            logger.info(f"Using Chrome binary: {chrome_binary}")
+            break
+    
+    # Try to find ChromeDriver (for Render/Linux environments)
+    # Check environment variable first (set by Dockerfile)
+    chromedriver_paths = [
+        os.getenv('CHROMEDRIVER_PATH'),  # From Dockerfile
+        '/usr/bin/chromedriver',
+        '/usr/lib/chromium-browser/chromedriver',
+    ]
+    # Filter out None values
+    chromedriver_paths = [p for p in chromedriver_paths if p]
+    chromedriver_path = None
+    for path in chromedriver_paths:
+        if os.path.exists(path):
+            chromedriver_path = path
+            logger.info(f"Using ChromeDriver: {chromedriver_path}")
+            break
+    
     try:
-        base_url = "https://y2down.cc/enmw/"
-        logger.info(f"Submitting YouTube URL to y2down.cc: {youtube_url}")
-        
-        # Setup Chrome options
-        chrome_options = Options()
-        chrome_options.add_argument('--headless')
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--disable-gpu')
-        chrome_options.add_argument('--window-size=1920,1080')
-        chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36')
-        chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-        chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-        chrome_options.add_experimental_option('useAutomationExtension', False)
-        
-        # Try to find Chrome/Chromium binary (for Render/Linux environments)
-        # Check environment variable first (set by Dockerfile)
-        chrome_binary_paths = [
-            os.getenv('CHROME_BIN'),  # From Dockerfile
-            '/usr/bin/chromium',
-            '/usr/bin/chromium-browser',
-            '/usr/bin/google-chrome',
-            '/usr/bin/chrome',
-        ]
-        # Filter out None values
-        chrome_binary_paths = [p for p in chrome_binary_paths if p]
-        chrome_binary = None
-        for path in chrome_binary_paths:
-            if os.path.exists(path):
-                chrome_binary = path
-                chrome_options.binary_location = chrome_binary
-                logger.info(f"Using Chrome binary: {chrome_binary}")
-                break
-        
-        # Try to find ChromeDriver (for Render/Linux environments)
-        # Check environment variable first (set by Dockerfile)
-        chromedriver_paths = [
-            os.getenv('CHROMEDRIVER_PATH'),  # From Dockerfile
-            '/usr/bin/chromedriver',
-            '/usr/lib/chromium-browser/chromedriver',
-        ]
-        # Filter out None values
-        chromedriver_paths = [p for p in chromedriver_paths if p]
-        chromedriver_path = None
-        for path in chromedriver_paths:
-            if os.path.exists(path):
-                chromedriver_path = path
-                logger.info(f"Using ChromeDriver: {chromedriver_path}")
-                break
-        
+        if chromedriver_path:
+            service = Service(chromedriver_path)
+            driver = webdriver.Chrome(service=service, options=chrome_options)
+        else:
+            # Fallback to webdriver-manager
+            from webdriver_manager.chrome import ChromeDriverManager
+            service = Service(ChromeDriverManager().install())
+            driver = webdriver.Chrome(service=service, options=chrome_options)
+    except Exception as e:
+        logger.warning(f"Failed to use ChromeDriverManager: {e}, trying default Chrome")
         try:
-            if chromedriver_path:
-                service = Service(chromedriver_path)
-                driver = webdriver.Chrome(service=service, options=chrome_options)
-            else:
-                # Fallback to webdriver-manager
-                from webdriver_manager.chrome import ChromeDriverManager
-                service = Service(ChromeDriverManager().install())
-                driver = webdriver.Chrome(service=service, options=chrome_options)
+            driver = webdriver.Chrome(options=chrome_options)
+        except Exception as e2:
+            logger.error(f"Failed to start Chrome: {e2}")
+            return None
+    
+    logger.info("Headless browser started")
+    return driver
+
+
+class _DriverPool:
+    """Pool of long-lived headless Chrome drivers reused across requests."""
+    
+    def __init__(self, size: int):
+        self._idle = queue.Queue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+    
+    def get(self) -> Optional[webdriver.Chrome]:
+        """Check out a healthy driver, starting a new one if none are idle."""
+        self._slots.acquire()
+        driver = None
+        try:
+            while driver is None:
+                try:
+                    idle = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if self._is_healthy(idle):
+                    driver = idle
+                else:
+                    logger.warning("Replacing unresponsive Chrome driver")
+                    self._discard(idle)
+            if driver is None:
+                driver = _create_driver()
+        finally:
+            if driver is None:
+                self._slots.release()
+        return driver
+    
+    def put(self, driver: webdriver.Chrome):
+        """Reset a driver and return it to the pool, discarding it if it is broken."""
+        try:
+            driver.delete_all_cookies()
+            driver.get('about:blank')
+            self._idle.put_nowait(driver)
         except Exception as e:
-            logger.warning(f"Failed to use ChromeDriverManager: {e}, trying default Chrome")
+            logger.warning(f"Discarding Chrome driver after failed reset: {e}")
+            self._discard(driver)
+        finally:
+            self._slots.release()
+    
+    def close_all(self):
+        """Quit all idle drivers."""
+        while True:
             try:
-                driver = webdriver.Chrome(options=chrome_options)
-            except Exception as e2:
-                logger.error(f"Failed to start Chrome: {e2}")
-                return None, None, None
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+    
+    @staticmethod
+    def _is_healthy(driver: webdriver.Chrome) -> bool:
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+    
+    @staticmethod
+    def _discard(driver: webdriver.Chrome):
+        try:
+            driver.quit()
+        except:
+            pass
+
+
+_driver_pool = _DriverPool(DRIVER_POOL_SIZE)
+atexit.register(_driver_pool.close_all)
+
+
+def _guess_format(url: str) -> Optional[str]:
+    """Return the media extension found in a URL (e.g. 'wav'), or None."""
+    m = _FMT_EXT_RE.search(url)
+    return m.group(1).lower() if m else None
+
+
+def _is_download_href(href: Optional[str]) -> bool:
+    """Check that a link's href looks like a real download URL rather than a site page."""
+    return bool(
+        href and href.startswith('http') and len(href) > 40 and
+        'y2down.cc/en' not in href and
+        'y2down.cc/' != href and
+        (any(ext in href.lower() for ext in ['.mp4', '.mp3', '.webm', '.m4a', '.wav', '.flac']) or
+         ('download' in href.lower() and ('api' in href.lower() or 'cdn' in href.lower() or 'storage' in href.lower() or 'get' in href.lower()) and len(href) > 50))
+    )
+
+
+def _pick_download_url(html: str) -> Tuple[Optional[str], Optional[str]]:
+    """Find the first plausible media download URL in a page's HTML."""
+    for pat in _DL_URL_PATTERNS:
+        matches = pat.findall(html)
+        for match in matches:
+            if (match and len(match) > 40 and 
+                'y2down.cc/en' not in match and 
+                'y2down.cc/' != match and
+                '.xml' not in match and
+                (any(ext in match.lower() for ext in ['.mp4', '.mp3', '.webm', '.m4a', '.wav', '.flac']) or 
+                 ('download' in match.lower() and ('api' in match.lower() or 'get' in match.lower()) and len(match) > 50))):
+                return match, _guess_format(match)
+    return None, None
+
+
+def _is_media_url(download_url: str) -> bool:
+    """Check that a URL scraped from a page actually serves audio/video rather than some other asset."""
+    try:
+        response = _session.head(download_url, allow_redirects=True, timeout=10)
+    except requests.RequestException as e:
+        logger.info(f"Candidate download URL not reachable: {e}")
+        return False
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    return response.status_code < 400 and (
+        content_type.startswith(('audio/', 'video/')) or content_type == 'application/octet-stream')
+
+
+def _resolve_via_http(youtube_url: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Try to get the download URL from y2down.cc with a plain form POST (no browser)."""
+    try:
+        response = _session.post(Y2DOWN_URL, data={'url': youtube_url}, timeout=20,
+                                 headers={'Referer': Y2DOWN_URL})
+        response.raise_for_status()
+        
+        download_url, file_format = _pick_download_url(response.text)
+        # The form fields are a best guess, so only trust a link that really serves media;
+        # otherwise the page's own assets could be cached as the video's download URL
+        if download_url and _is_media_url(download_url):
+            logger.info(f"Found download URL via HTTP: {download_url}")
+            return download_url, None, file_format or 'mp4'
+        logger.info("No usable download URL in y2down.cc HTTP response")
+    except requests.RequestException as e:
+        logger.info(f"HTTP lookup on y2down.cc failed: {e}")
+    return None, None, None
+
+
+def _resolve_download_url(youtube_url: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Get download URL from y2down.cc, trying plain HTTP first when enabled and falling back to the headless browser."""
+    if Y2DOWN_HTTP_LOOKUP:
+        result = _resolve_via_http(youtube_url)
+        if result[0]:
+            return result
+    return _resolve_via_browser(youtube_url)
+
+
+def _resolve_via_browser(youtube_url: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Get download URL from y2down.cc using headless browser."""
+    driver = None
+    try:
+        base_url = Y2DOWN_URL
+        logger.info(f"Submitting YouTube URL to y2down.cc: {youtube_url}")
+        
+        driver = _driver_pool.get()
+        if driver is None:
+            return None, None, None
         
-        logger.info("Headless browser started")
         driver.get(base_url)
         logger.info(f"Loaded page: {driver.current_url}")
         
@@ -136,82 +455,100 @@ def get_download_url(youtube_url: str) -> Tuple[Optional[str], Optional[str], Op
             except:
                 pass
         
-        # Wait for page to process and show download options
+        # Wait until a download link appears (or the page redirects to the file)
         logger.info("Waiting for download links...")
-        time.sleep(8)
+        try:
+            wait.until(EC.any_of(
+                EC.presence_of_element_located((By.CSS_SELECTOR, "a[href*='.wav'], a[href*='.mp3'], a[href*='.mp4'], a[download]")),
+                EC.url_contains('.wav'),
+                EC.url_contains('.mp3'),
+                EC.url_contains('.mp4'),
+            ))
+        except TimeoutException:
+            logger.info("No download link appeared yet, probing format buttons")
         
         # Check if page redirected or updated
         current_url = driver.current_url
         logger.info(f"Current URL after submission: {current_url}")
         
-        # Wait for download buttons/links to appear
-        try:
-            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "a, button")))
-        except:
-            pass
-        
-        time.sleep(5)
+        download_url = None
+        video_title = None
+        file_format = 'mp4'
         
-        # Try clicking format buttons (WAV, MP3, MP4, etc.)
+        # Try format buttons (WAV, MP3, MP4, etc.)
         try:
             # Look for format buttons - they might be in different formats
             format_selectors = [
+                (By.CSS_SELECTOR, "a[href*='wav']"),
+                (By.CSS_SELECTOR, "a[href*='mp3']"),
+                (By.CSS_SELECTOR, "a[href*='mp4']"),
                 (By.XPATH, "//a[contains(text(), 'WAV')]"),
                 (By.XPATH, "//a[contains(text(), 'MP3')]"),
                 (By.XPATH, "//a[contains(text(), 'MP4')]"),
                 (By.XPATH, "//button[contains(text(), 'WAV')]"),
                 (By.XPATH, "//button[contains(text(), 'MP3')]"),
                 (By.XPATH, "//button[contains(text(), 'Download')]"),
-                (By.CSS_SELECTOR, "a[href*='wav']"),
-                (By.CSS_SELECTOR, "a[href*='mp3']"),
-                (By.CSS_SELECTOR, "a[href*='mp4']"),
                 (By.CSS_SELECTOR, "button[onclick*='download']"),
             ]
             
+            # Collect the first usable element for each selector
+            candidates = []
+            seen = set()
             for by, selector in format_selectors:
                 try:
-                    buttons = driver.find_elements(by, selector)
-                    for btn in buttons[:5]:  # Try first 5
-                        try:
-                            if btn.is_displayed() and btn.is_enabled():
-                                btn_text = btn.text or btn.get_attribute('href') or ''
-                                logger.info(f"Trying to click: {btn_text[:50]}")
-                                btn.click()
-                                time.sleep(4)
-                                
-                                # Check if we got redirected to download
-                                new_url = driver.current_url
-                                if new_url != current_url:
-                                    logger.info(f"URL changed to: {new_url}")
-                                    if any(ext in new_url.lower() for ext in ['.mp4', '.mp3', '.wav', '.m4a', '.webm']):
-                                        logger.info(f"Redirected to download file: {new_url}")
-                                        format_ext = 'wav' if '.wav' in new_url.lower() else 'mp3' if '.mp3' in new_url.lower() else 'mp4'
-                                        return new_url, video_title, format_ext
-                                    # Check page source for download link
-                                    page_source = driver.page_source
-                                    import re
-                                    direct_url = re.search(r'https?://[^\s"\'<>]+\.(?:mp4|mp3|wav|m4a)', page_source, re.IGNORECASE)
-                                    if direct_url:
-                                        download_url = direct_url.group(0)
-                                        logger.info(f"Found direct download in new page: {download_url}")
-                                        return download_url, video_title, 'wav' if '.wav' in download_url.lower() else 'mp3'
-                                break
-                        except Exception as e:
-                            logger.debug(f"Error clicking button: {e}")
-                            continue
-                    if download_url:
-                        break
-                except:
+                    for btn in driver.find_elements(by, selector)[:5]:  # Try first 5
+                        if btn.id not in seen and btn.is_displayed() and btn.is_enabled():
+                            seen.add(btn.id)
+                            candidates.append((btn, btn.get_attribute('href') or ''))
+                            break
+                except Exception as e:
+                    logger.debug(f"Selector {selector} failed: {e}")
+            
+            # Links that already point at a media file need no clicking; prefer WAV.
+            # Use the href whole: signed CDN links carry their token in the query string
+            linked = []
+            for btn, href in candidates:
+                fmt = _guess_format(href)
+                if fmt and _is_download_href(href):
+                    linked.append((href, fmt))
+            linked.sort(key=lambda item: item[1] != 'wav')
+            if linked:
+                download_url, fmt = linked[0]
+                logger.info(f"Found download link on format button: {download_url}")
+                return download_url, video_title, fmt or file_format
+            
+            # Otherwise click buttons until one leads to a download
+            for btn, href in candidates:
+                try:
+                    btn_text = btn.text or href
+                    logger.info(f"Trying to click: {btn_text[:50]}")
+                    btn.click()
+                    try:
+                        WebDriverWait(driver, 4).until(EC.url_changes(current_url))
+                    except TimeoutException:
+                        continue
+                    
+                    # Check if we got redirected to download
+                    new_url = driver.current_url
+                    logger.info(f"URL changed to: {new_url}")
+                    if any(ext in new_url.lower() for ext in ['.mp4', '.mp3', '.wav', '.m4a', '.webm']):
+                        logger.info(f"Redirected to download file: {new_url}")
+                        format_ext = _guess_format(new_url) or 'mp4'
+                        return new_url, video_title, format_ext
+                    # Check page source for download link
+                    page_source = driver.page_source
+                    direct_url = _DIRECT_MEDIA_RE.search(page_source)
+                    if direct_url:
+                        download_url = direct_url.group(0)
+                        logger.info(f"Found direct download in new page: {download_url}")
+                        return download_url, video_title, _guess_format(download_url) or 'mp3'
+                    break
+                except Exception as e:
+                    logger.debug(f"Error clicking button: {e}")
                     continue
         except Exception as e:
             logger.warning(f"Error with format buttons: {e}")
         
-        time.sleep(3)  # Additional wait
-        
-        download_url = None
-        video_title = None
-        file_format = 'mp4'
-        
         # Look for download links with better filtering
         download_selectors = [
             (By.CSS_SELECTOR, "a[href*='.mp4']"),
@@ -235,31 +572,14 @@ def get_download_url(youtube_url: str) -> Tuple[Optional[str], Optional[str], Op
                     if href:
                         # Extract URL from onclick
                         if 'onclick' in str(href):
-                            import re
-                            url_match = re.search(r'https?://[^\s"\'<>)]+', href)
+                            url_match = _HTTP_URL_RE.search(href)
                             if url_match:
                                 href = url_match.group(0)
                         
                         # Validate it's a real download URL
-                        is_valid = (
-                            href and href.startswith('http') and len(href) > 40 and
-                            'y2down.cc/en' not in href and
-                            'y2down.cc/' != href and
-                            (any(ext in href.lower() for ext in ['.mp4', '.mp3', '.webm', '.m4a', '.wav', '.flac']) or
-                             ('download' in href.lower() and ('api' in href.lower() or 'cdn' in href.lower() or 'storage' in href.lower() or 'get' in href.lower()) and len(href) > 50))
-                        )
-                        if is_valid:
+                        if _is_download_href(href):
                             download_url = href
-                            if '.mp4' in href.lower():
-                                file_format = 'mp4'
-                            elif '.mp3' in href.lower():
-                                file_format = 'mp3'
-                            elif '.wav' in href.lower():
-                                file_format = 'wav'
-                            elif '.m4a' in href.lower():
-                                file_format = 'm4a'
-                            elif '.webm' in href.lower():
-                                file_format = 'webm'
+                            file_format = _guess_format(href) or file_format
                             logger.info(f"Found download URL: {download_url}")
                             break
                 if download_url:
@@ -271,7 +591,6 @@ def get_download_url(youtube_url: str) -> Tuple[Optional[str], Optional[str], Op
         # Check page source for URLs
         if not download_url:
             page_source = driver.page_source
-            import re
             
             # Debug: check what's on the page
             logger.info(f"Page title: {driver.title}")
@@ -289,39 +608,10 @@ def get_download_url(youtube_url: str) -> Tuple[Optional[str], Optional[str], Op
             except:
                 pass
             
-            patterns = [
-                r'https?://[^\s"\'<>]+\.(?:mp4|mp3|webm|m4a|wav|flac)',
-                r'["\'](https?://[^"\']*download[^"\']*\.(?:mp4|mp3|webm|m4a|wav|flac)[^"\']*)["\']',
-                r'downloadUrl["\']?\s*[:=]\s*["\'](https?://[^"\']+)["\']',
-                r'url["\']?\s*[:=]\s*["\'](https?://[^"\']*\.(?:mp4|mp3|wav|m4a)[^"\']*)["\']',
-                r'https?://[^"\'\s<>]+/get/[^"\'\s<>]+',
-                r'https?://[^"\'\s<>]+/download/[^"\'\s<>]+',
-                r'https?://[^"\'\s<>]*y2down[^"\'\s<>]*/get[^"\'\s<>]+',
-            ]
-            for pattern in patterns:
-                matches = re.findall(pattern, page_source, re.IGNORECASE)
-                for match in matches:
-                    if (match and len(match) > 40 and 
-                        'y2down.cc/en' not in match and 
-                        'y2down.cc/' != match and
-                        '.xml' not in match and
-                        (any(ext in match.lower() for ext in ['.mp4', '.mp3', '.webm', '.m4a', '.wav', '.flac']) or 
-                         ('download' in match.lower() and ('api' in match.lower() or 'get' in match.lower()) and len(match) > 50))):
-                        download_url = match
-                        if '.mp4' in download_url.lower():
-                            file_format = 'mp4'
-                        elif '.mp3' in download_url.lower():
-                            file_format = 'mp3'
-                        elif '.wav' in download_url.lower():
-                            file_format = 'wav'
-                        elif '.m4a' in download_url.lower():
-                            file_format = 'm4a'
-                        elif '.webm' in download_url.lower():
-                            file_format = 'webm'
-                        logger.info(f"Found download URL in source: {download_url}")
-                        break
-                if download_url:
-                    break
+            download_url, source_format = _pick_download_url(page_source)
+            if download_url:
+                file_format = source_format or file_format
+                logger.info(f"Found download URL in source: {download_url}")
         
         if download_url:
             return download_url, video_title, file_format
@@ -342,34 +632,95 @@ def get_download_url(youtube_url: str) -> Tuple[Optional[str], Optional[str], Op
             
     except Exception as e:
         logger.error(f"Error: {e}")
-        import traceback
         logger.error(traceback.format_exc())
         return None, None, None
     finally:
         if driver:
-            try:
-                driver.quit()
-            except:
-                pass
+            _driver_pool.put(driver)
+
+
+def _open_download(download_url: str, timeout: int) -> requests.Response:
+    """Start a streamed GET whose raw socket can be read directly."""
+    # Media is piped through unmodified, so ask for it unencoded
+    response = _session.get(download_url, stream=True, timeout=timeout,
+                            headers={'Accept-Encoding': 'identity'})
+    response.raise_for_status()
+    # Read straight from the socket, bypassing iter_content's per-chunk decoding
+    response.raw.decode_content = False
+    return response
 
 
-def stream_download(download_url: str, chunk_size: int = 8192):
+def stream_download(download_url: str, chunk_size: int = CHUNK_SIZE):
     """Stream download from a URL."""
     try:
-        session = requests.Session()
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': '*/*',
-            'Referer': 'https://y2down.cc/',
-        })
-        
-        response = session.get(download_url, stream=True, timeout=30)
-        response.raise_for_status()
-        
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            if chunk:
+        with _open_download(download_url, timeout=30) as response:
+            while True:
+                chunk = response.raw.read(chunk_size)
+                if not chunk:
+                    break
                 yield chunk
                 
     except Exception as e:
         logger.error(f"Error streaming download: {e}")
         raise
+
+
+def _write_at(fd: int, source, offset: int, length: int):
+    """Copy exactly length bytes from a raw response into fd starting at offset."""
+    while length > 0:
+        chunk = source.read(min(FILE_CHUNK_SIZE, length))
+        if not chunk:
+            raise IOError(f"Connection closed with {length} bytes of range still unread")
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        length -= len(chunk)
+
+
+def _fetch_range(download_url: str, fd: int, start: int, end: int):
+    """Download bytes start..end (inclusive) of a URL into fd at the same offset."""
+    headers = {'Accept-Encoding': 'identity', 'Range': f'bytes={start}-{end}'}
+    with _session.get(download_url, stream=True, timeout=300, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Server ignored Range request (HTTP {response.status_code})")
+        response.raw.decode_content = False
+        _write_at(fd, response.raw, start, end - start + 1)
+
+
+def _download_ranges(download_url: str, response: requests.Response, file_path: str, total: int):
+    """Fill file_path using parallel Range requests; the open response supplies the first range."""
+    part = -(-total // DOWNLOAD_CONNECTIONS)
+    ranges = [(start, min(start + part, total) - 1) for start in range(0, total, part)]
+    logger.info(f"Downloading {total} bytes over {len(ranges)} connections")
+    
+    with open(file_path, 'wb') as f:
+        f.truncate(total)
+        fd = f.fileno()
+        with ThreadPoolExecutor(max_workers=len(ranges) - 1, thread_name_prefix='range') as pool:
+            futures = [pool.submit(_fetch_range, download_url, fd, start, end) for start, end in ranges[1:]]
+            _write_at(fd, response.raw, 0, ranges[0][1] + 1)
+            for future in futures:
+                future.result()
+
+
+def download_to_file(download_url: str, file_path: str):
+    """Download a URL to a local file."""
+    with _open_download(download_url, timeout=300) as response:
+        total = int(response.headers.get('Content-Length') or 0)
+        ranged = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        if not (ranged and DOWNLOAD_CONNECTIONS > 1 and total >= RANGE_SPLIT_MIN_SIZE):
+            with open(file_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=FILE_CHUNK_SIZE)
+            return
+        try:
+            _download_ranges(download_url, response, file_path, total)
+            return
+        except Exception as e:
+            logger.warning(f"Parallel download failed, retrying over a single connection: {e}")
+    
+    with _open_download(download_url, timeout=300) as response:
+        with open(file_path, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, length=FILE_CHUNK_SIZE)
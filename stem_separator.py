@@ -4,133 +4,424 @@ Stem Separation Module using Demucs v4
 Handles audio stem separation using Facebook's Demucs v4 model
 """
 
+import atexit
+import hashlib
 import logging
 import os
+import re
+import shutil
 import subprocess
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 from pathlib import Path
 import tempfile
+import threading
+import traceback
+import uuid
+import torch
 
 logger = logging.getLogger(__name__)
 
+# Input windows have a fixed shape, so let cuDNN pick the fastest kernels once and reuse them
+torch.backends.cudnn.benchmark = True
+
+# Separation runs on native threads even under gevent, where a patched threading.Lock
+# can't wake a waiter on another thread; always lock with a real OS lock
+try:
+    from gevent.monkey import get_original
+    _NativeLock = get_original('threading', 'Lock')
+except ImportError:
+    _NativeLock = threading.Lock
+
+# Finished stems are kept here by input content hash so repeated inputs skip Demucs entirely.
+# Caching is off unless a directory is configured; the least recently used entries are
+# removed once the cache grows past STEM_CACHE_MAX_BYTES
+STEM_CACHE_DIR = os.getenv('STEM_CACHE_DIR')
+STEM_CACHE_MAX_BYTES = int(os.getenv('STEM_CACHE_MAX_MB', 10240)) * 1024 * 1024
+# Cache entries are named {model}-{quality}-{sha256}; anything else in the directory is left alone
+_STEM_CACHE_ENTRY_RE = re.compile(r'^[\w.]+(?:-[\w.]+)*-(?:high|fast)-[0-9a-f]{64}$')
+
+# Parent of the default output directories, created on first use and removed when the process exits
+_default_output_root: Optional[tempfile.TemporaryDirectory] = None
+_default_output_root_lock = _NativeLock()
+
+
+def _default_output_dir() -> str:
+    """Return a fresh directory under the per-process stems temp dir."""
+    global _default_output_root
+    with _default_output_root_lock:
+        if _default_output_root is None:
+            _default_output_root = tempfile.TemporaryDirectory(prefix='stems_')
+            atexit.register(_default_output_root.cleanup)
+    return os.path.join(_default_output_root.name, uuid.uuid4().hex)
+
+
+def _link_or_copy(src: str, dst: str):
+    """Hardlink src to dst, replacing any existing dst; copies instead across filesystems."""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp_path = f"{dst}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def _prune_stem_cache():
+    """Delete the least recently used stem cache entries until the cache fits STEM_CACHE_MAX_BYTES."""
+    entries = []
+    total = 0
+    for entry in os.scandir(STEM_CACHE_DIR):
+        if not entry.is_dir() or not _STEM_CACHE_ENTRY_RE.match(entry.name):
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        entries.append((entry.stat().st_mtime, size, entry.path))
+        total += size
+    for _, size, path in sorted(entries):
+        if total <= STEM_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def detect_device() -> str:
+    """Pick the fastest available torch device: CUDA, then Apple MPS, then CPU."""
+    if torch.cuda.is_available():
+        return 'cuda'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
 
 class DemucsSeparator:
     """Demucs v4 stem separator."""
     
-    def __init__(self, model: str = "htdemucs", device: Optional[str] = None):
+    # Overlap between split windows for each quality setting; less overlap means less inference work
+    OVERLAP_BY_QUALITY = {'high': 0.25, 'fast': 0.1}
+    
+    def __init__(self, model: str = "htdemucs", device: Optional[str] = None,
+                 half_precision: Optional[bool] = None):
         """
         Initialize Demucs separator.
         
         Args:
             model: Demucs model to use (default: htdemucs for v4)
             device: Device to use ('cpu', 'cuda', etc.). Auto-detects if None.
+            half_precision: Run inference under float16 autocast. Defaults to on for CUDA.
         """
         self.model = model
-        self.device = device
+        self.device = device or detect_device()
+        self.half_precision = self.device.startswith('cuda') if half_precision is None else half_precision
+        self._model = None
+        self._model_lock = _NativeLock()
+    
+    def _load_model(self):
+        """Load the Demucs model onto the device once and keep it for every later separation."""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from demucs.pretrained import get_model
+                    model = get_model(self.model)
+                    model.to(self.device)
+                    model.eval()
+                    self._model = model
+                    logger.info(f"Demucs model ready: {self.model} on {self.device}")
+        return self._model
+    
+    def warmup(self):
+        """
+        Load the model ahead of time so the first separation doesn't pay for the download and load.
+        
+        Safe to call from a background thread; failures are logged and left for
+        separate_audio to surface.
+        """
+        try:
+            self._load_model()
+        except Exception as e:
+            logger.warning(f"Demucs warmup failed: {e}")
+    
+    def _load_normalized(self, audio_file_path: str):
+        """Load a file at the model's rate/channels, normalized like the demucs CLI. Returns (wav, mean, std)."""
+        from demucs.audio import convert_audio
+        import soundfile
+        
+        model = self._load_model()
+        # Decode in-process: demucs' own loader shells out to ffmpeg, and under gevent this runs on a
+        # threadpool thread where patched subprocess can't spawn children. Input is already WAV
+        # after prepare_audio.
+        data, samplerate = soundfile.read(audio_file_path, dtype='float32', always_2d=True)
+        wav = convert_audio(torch.from_numpy(data.T.copy()), samplerate, model.samplerate, model.audio_channels)
         
-    def separate_audio(self, audio_file_path: str, output_dir: Optional[str] = None) -> Dict[str, str]:
+        ref = wav.mean(0)
+        mean, std = ref.mean(), ref.std()
+        return (wav - mean) / std, mean, std
+    
+    def _save_stems(self, sources: torch.Tensor, output_dir: str) -> Dict[str, str]:
+        """Write each separated source to output_dir/<stem>.wav.
+        
+        Each stem is written under a temporary name and moved into place, so a path that is
+        hardlinked into the stem cache is replaced rather than overwritten through the link.
+        """
+        from demucs.audio import save_audio
+        
+        model = self._load_model()
+        os.makedirs(output_dir, exist_ok=True)
+        stem_files = {}
+        for source, stem_name in zip(sources, model.sources):
+            stem_path = os.path.join(output_dir, f"{stem_name}.wav")
+            tmp_path = os.path.join(output_dir, f".{stem_name}.{uuid.uuid4().hex}.wav")
+            try:
+                save_audio(source.cpu(), tmp_path, samplerate=model.samplerate)
+                os.replace(tmp_path, stem_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            stem_files[stem_name] = stem_path
+        return stem_files
+    
+    def _separate_to(self, audio_file_path: str, output_dir: str, quality: str) -> Dict[str, str]:
+        """Run the loaded model on one file and write each stem to output_dir/<stem>.wav."""
+        wav, mean, std = self._load_normalized(audio_file_path)
+        sources = self._apply(self._load_model(), wav[None], quality)[0]
+        # Undo the input normalization on the separated sources
+        return self._save_stems(sources * std + mean, output_dir)
+    
+    def _apply(self, model, mix: torch.Tensor, quality: str) -> torch.Tensor:
+        """Run apply_model on a (batch, channels, time) mix, in float16 when enabled."""
+        from demucs.apply import apply_model
+        
+        kwargs = {
+            'device': self.device,
+            'split': True,
+            'overlap': self.OVERLAP_BY_QUALITY[quality],
+            'progress': False,
+        }
+        if self.half_precision:
+            try:
+                with torch.autocast('cuda', dtype=torch.float16):
+                    return apply_model(model, mix, **kwargs).float()
+            except RuntimeError as e:
+                # Some torch builds lack half-precision complex STFT ops; stay in float32 from then on
+                logger.warning(f"Half-precision Demucs inference failed, falling back to float32: {e}")
+                self.half_precision = False
+        return apply_model(model, mix, **kwargs)
+    
+    def _cache_dir_for(self, audio_file_path: str, quality: str) -> Optional[str]:
+        """Stem cache directory for this input's content under the current model and quality, or None if caching is off."""
+        if not STEM_CACHE_DIR:
+            return None
+        try:
+            with open(audio_file_path, 'rb') as f:
+                digest = hashlib.file_digest(f, 'sha256').hexdigest()
+        except OSError as e:
+            logger.warning(f"Could not hash {audio_file_path} for the stem cache: {e}")
+            return None
+        return os.path.join(STEM_CACHE_DIR, f"{self.model}-{quality}-{digest}")
+    
+    def _load_cached(self, cache_dir: Optional[str], output_dir: str) -> Dict[str, str]:
+        """Link cached stems into output_dir, returning {} on a cache miss or any cache error."""
+        if not cache_dir or not os.path.isdir(cache_dir):
+            return {}
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            stem_files = {}
+            for name in os.listdir(cache_dir):
+                stem_path = os.path.join(output_dir, name)
+                _link_or_copy(os.path.join(cache_dir, name), stem_path)
+                stem_files[Path(name).stem] = stem_path
+            os.utime(cache_dir)
+            return stem_files
+        except OSError as e:
+            logger.warning(f"Could not read cached stems from {cache_dir}: {e}")
+            return {}
+    
+    def _store_cached(self, cache_dir: Optional[str], stem_files: Dict[str, str]):
+        """Add freshly separated stems to the cache; failures are logged and never affect the result."""
+        if not cache_dir or not stem_files:
+            return
+        staging_dir = None
+        try:
+            os.makedirs(STEM_CACHE_DIR, exist_ok=True)
+            # The entry only appears once complete
+            staging_dir = tempfile.mkdtemp(dir=STEM_CACHE_DIR, prefix='.staging_')
+            for stem_path in stem_files.values():
+                _link_or_copy(stem_path, os.path.join(staging_dir, os.path.basename(stem_path)))
+            os.rename(staging_dir, cache_dir)
+            staging_dir = None
+            _prune_stem_cache()
+        except Exception as e:
+            # Another process may have cached the same input first
+            logger.warning(f"Could not cache stems in {cache_dir}: {e}")
+        finally:
+            if staging_dir:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    def separate_audio(self, audio_file_path: str, output_dir: Optional[str] = None,
+                       quality: str = 'high') -> Dict[str, str]:
         """
         Separate audio file into stems using Demucs.
         
         Args:
             audio_file_path: Path to audio file to separate
-            output_dir: Directory for output stems (defaults to temp directory)
+            output_dir: Directory for output stems (defaults to a new directory under a per-process temp dir)
+            quality: 'high' (Demucs defaults) or 'fast' (less window overlap, quicker on CPU)
             
         Returns:
             Dictionary mapping stem names to file paths
         """
         if output_dir is None:
-            output_dir = tempfile.mkdtemp(prefix='stems_')
-        
-        os.makedirs(output_dir, exist_ok=True)
+            output_dir = _default_output_dir()
         
         try:
-            # Build demucs command
-            cmd = [
-                'python', '-m', 'demucs.separate',
-                '--model', self.model,
-                '--out', output_dir,
-                '--filename', '{stem}.{ext}',
-            ]
-            
-            # Add device if specified
-            if self.device:
-                cmd.extend(['--device', self.device])
-            
-            # Add input file
-            cmd.append(audio_file_path)
-            
-            logger.info(f"Running Demucs separation: {' '.join(cmd)}")
-            
-            # Run demucs
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=1800  # 30 minute timeout
-            )
-            
-            if result.returncode != 0:
-                logger.error(f"Demucs separation failed: {result.stderr}")
-                return {}
-            
-            logger.info(f"Demucs separation completed. Output: {result.stdout}")
-            
-            # Find the output files
-            # Demucs creates: output_dir/model_name/track_name/stem.wav
-            stem_files = {}
-            base_name = Path(audio_file_path).stem
-            
-            # Look for the separated files
-            model_dir = os.path.join(output_dir, self.model)
-            if os.path.exists(model_dir):
-                track_dir = None
-                # Find the track directory (usually matches input filename)
-                for item in os.listdir(model_dir):
-                    item_path = os.path.join(model_dir, item)
-                    if os.path.isdir(item_path):
-                        track_dir = item_path
-                        break
-                
-                if track_dir:
-                    # Demucs outputs: vocals.wav, drums.wav, bass.wav, other.wav
-                    stem_names = ['vocals', 'drums', 'bass', 'other']
-                    for stem_name in stem_names:
-                        stem_path = os.path.join(track_dir, f"{stem_name}.wav")
-                        if os.path.exists(stem_path):
-                            # Copy to output_dir with simpler naming
-                            output_path = os.path.join(output_dir, f"{stem_name}.wav")
-                            import shutil
-                            shutil.copy2(stem_path, output_path)
-                            stem_files[stem_name] = output_path
-                            logger.info(f"Found stem: {stem_name} -> {output_path}")
-            
-            if not stem_files:
-                logger.warning("No stem files found after separation")
-                # Try alternative location structure
-                for root, dirs, files in os.walk(output_dir):
-                    for file in files:
-                        if file.endswith('.wav'):
-                            file_path = os.path.join(root, file)
-                            stem_name = Path(file).stem
-                            if stem_name in ['vocals', 'drums', 'bass', 'other']:
-                                output_path = os.path.join(output_dir, f"{stem_name}.wav")
-                                if file_path != output_path:
-                                    import shutil
-                                    shutil.copy2(file_path, output_path)
-                                stem_files[stem_name] = output_path
+            cache_dir = self._cache_dir_for(audio_file_path, quality)
+            stem_files = self._load_cached(cache_dir, output_dir)
+            if stem_files:
+                logger.info(f"Using cached stems for {audio_file_path}: {list(stem_files.keys())}")
+                return stem_files
             
+            logger.info(f"Running Demucs separation on {self.device}: {audio_file_path}")
+            stem_files = self._separate_to(audio_file_path, output_dir, quality)
             logger.info(f"Separated {len(stem_files)} stems: {list(stem_files.keys())}")
+            self._store_cached(cache_dir, stem_files)
             return stem_files
             
-        except subprocess.TimeoutExpired:
-            logger.error("Demucs separation timed out after 30 minutes")
-            return {}
         except Exception as e:
             logger.error(f"Error during Demucs separation: {e}")
-            import traceback
             logger.error(traceback.format_exc())
             return {}
+    
+    def separate_audio_batch(self, audio_file_paths: List[str], output_dirs: List[str],
+                             quality: str = 'high') -> Dict[str, Dict[str, str]]:
+        """
+        Separate several audio files with a single model call by stacking them into one batch.
+        
+        Shorter tracks are zero-padded to the longest one, so the files should be
+        of similar duration (see separate_audio_files, which groups them that way).
+        
+        Args:
+            audio_file_paths: Paths to audio files to separate
+            output_dirs: Output directory for each file's stems, in the same order
+            quality: 'high' (Demucs defaults) or 'fast' (less window overlap, quicker on CPU)
+            
+        Returns:
+            Dictionary mapping each input path to its stem name -> file path dictionary
+        """
+        loaded = [self._load_normalized(path) for path in audio_file_paths]
+        length = max(wav.shape[-1] for wav, _, _ in loaded)
+        mix = torch.stack([torch.nn.functional.pad(wav, (0, length - wav.shape[-1])) for wav, _, _ in loaded])
+        
+        logger.info(f"Running Demucs separation on {self.device} for a batch of {len(loaded)} files")
+        batch_sources = self._apply(self._load_model(), mix, quality)
+        
+        results = {}
+        for path, output_dir, (wav, mean, std), sources in zip(audio_file_paths, output_dirs, loaded, batch_sources):
+            sources = sources[..., :wav.shape[-1]] * std + mean
+            results[path] = self._save_stems(sources, output_dir)
+            self._store_cached(self._cache_dir_for(path, quality), results[path])
+        return results
+    
+    def separate_audio_files(self, audio_file_paths: List[str], output_dir: Optional[str] = None,
+                             quality: str = 'high', max_batch: int = 4) -> Dict[str, Dict[str, str]]:
+        """
+        Separate several audio files with the same loaded model, batching tracks of similar length.
+        
+        Args:
+            audio_file_paths: Paths to audio files to separate (file names must be unique)
+            output_dir: Directory for output stems (defaults to a new directory under a
+                per-process temp dir); each file's stems go in a subdirectory named after it
+            quality: 'high' (Demucs defaults) or 'fast' (less window overlap, quicker on CPU)
+            max_batch: Most files to run through the model at once
+            
+        Returns:
+            Dictionary mapping each input path to its stem name -> file path dictionary
+            (empty for inputs that produced no stems)
+        """
+        import soundfile
+        
+        if output_dir is None:
+            output_dir = _default_output_dir()
+        
+        results = {path: {} for path in audio_file_paths}
+        pending = []
+        for path in audio_file_paths:
+            results[path] = self._load_cached(self._cache_dir_for(path, quality),
+                                              os.path.join(output_dir, Path(path).stem))
+            if not results[path]:
+                pending.append(path)
+        
+        durations = {}
+        for path in pending:
+            try:
+                durations[path] = soundfile.info(path).duration
+            except Exception as e:
+                logger.warning(f"Could not read duration of {path}, separating it on its own: {e}")
+                durations[path] = None
+        
+        # Group tracks whose durations are within 10% of each other so padding wastes little work
+        groups = [[path] for path in pending if durations[path] is None]
+        for path in sorted((p for p in pending if durations[p] is not None), key=durations.get):
+            group = groups[-1] if groups and durations[groups[-1][0]] is not None else None
+            if group and len(group) < max_batch and durations[path] <= durations[group[0]] * 1.1:
+                group.append(path)
+            else:
+                groups.append([path])
+        
+        for group in groups:
+            output_dirs = [os.path.join(output_dir, Path(path).stem) for path in group]
+            if len(group) == 1:
+                results[group[0]] = self.separate_audio(group[0], output_dirs[0], quality=quality)
+                continue
+            try:
+                results.update(self.separate_audio_batch(group, output_dirs, quality=quality))
+            except Exception as e:
+                logger.warning(f"Batched separation failed, separating files one at a time: {e}")
+                for path, track_dir in zip(group, output_dirs):
+                    results[path] = self.separate_audio(path, track_dir, quality=quality)
+        return results
+
+
+def prepare_audio(audio_file_path: str, output_dir: str) -> str:
+    """
+    Convert audio to 44.1 kHz stereo 16-bit WAV, the format htdemucs works in.
+    
+    Args:
+        audio_file_path: Path to the source audio (any format ffmpeg can read)
+        output_dir: Directory for the converted file
+        
+    Returns:
+        Path to the converted file, or the original path if it is already in
+        that format or the conversion could not be done
+    """
+    try:
+        probe = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+             '-show_entries', 'stream=codec_name,sample_rate,channels',
+             '-of', 'csv=p=0', audio_file_path],
+            capture_output=True,
+            text=True,
+            timeout=60
+        )
+        if probe.returncode == 0 and probe.stdout.strip() == 'pcm_s16le,44100,2':
+            logger.info(f"Audio already 44.1 kHz stereo s16: {audio_file_path}")
+            return audio_file_path
+        
+        prepared_path = os.path.join(output_dir, f"{Path(audio_file_path).stem}_44k.wav")
+        subprocess.run(
+            ['ffmpeg', '-y', '-v', 'error', '-i', audio_file_path,
+             '-vn', '-ac', '2', '-ar', '44100', '-sample_fmt', 's16', prepared_path],
+            check=True,
+            capture_output=True,
+            timeout=600
+        )
+        logger.info(f"Converted audio for Demucs: {prepared_path}")
+        return prepared_path
+    except FileNotFoundError:
+        logger.warning("ffmpeg not found, passing audio to Demucs unconverted")
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"ffmpeg conversion failed, passing audio to Demucs unconverted: {e.stderr}")
+    except subprocess.TimeoutExpired:
+        logger.warning("ffmpeg conversion timed out, passing audio to Demucs unconverted")
+    return audio_file_path
 
 
 def separate_audio_file(audio_file_path: str, output_dir: Optional[str] = None, model: str = "htdemucs") -> Dict[str, str]:
@@ -0,0 +1,54 @@
+"""Stem separation must work from gevent's native threadpool, as it runs in the gevent worker."""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('gevent')
+pytest.importorskip('torch')
+pytest.importorskip('demucs')
+pytest.importorskip('soundfile')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a child process so monkey-patching doesn't leak into the rest of the test session
+SCRIPT = textwrap.dedent('''
+    from gevent import monkey
+    monkey.patch_all()
+
+    import os
+    import sys
+    import numpy as np
+    import soundfile
+    from gevent import get_hub
+    import stem_separator
+
+    class FakeModel:
+        audio_channels = 2
+        samplerate = 44100
+        sources = ['drums', 'bass', 'other', 'vocals']
+
+    work_dir = sys.argv[1]
+    audio_path = os.path.join(work_dir, 'audio.wav')
+    soundfile.write(audio_path, np.random.uniform(-0.5, 0.5, (44100, 2)).astype('float32'), 44100)
+
+    separator = stem_separator.DemucsSeparator(device='cpu')
+    # Skip the weight download; echo the mix back as every source
+    separator._model = FakeModel()
+    separator._apply = lambda model, mix, quality: mix[:, None].repeat(1, len(model.sources), 1, 1)
+
+    stems = get_hub().threadpool.apply(separator.separate_audio, (audio_path, os.path.join(work_dir, 'stems')))
+    assert sorted(stems) == sorted(FakeModel.sources), stems
+    assert all(os.path.getsize(path) > 0 for path in stems.values())
+''')
+
+
+def test_separate_audio_on_gevent_threadpool(tmp_path):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    env.pop('STEM_CACHE_DIR', None)
+    result = subprocess.run([sys.executable, '-c', SCRIPT, str(tmp_path)],
+                            capture_output=True, text=True, env=env, timeout=300)
+    assert result.returncode == 0, result.stderr